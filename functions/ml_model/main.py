@@ -1,7 +1,9 @@
 import firebase_admin
-from firebase_admin import storage, credentials, db
-from firebase_functions import https_fn, db_fn
+from firebase_admin import storage, credentials, db, auth
+from firebase_functions import https_fn, db_fn, scheduler_fn
 import os
+import json
+import time
 from datetime import datetime
 
 # Initialize Firebase App once - do this BEFORE heavy imports
@@ -419,4 +421,458 @@ def predict_on_new_data(event: db_fn.Change):
         print(f"❌ Error in database trigger: {e}")
         import traceback
         traceback.print_exc()
-        # Don't re-raise to avoid function retry loops
\ No newline at end of file
+        # Don't re-raise to avoid function retry loops
+
+# ================================================
+# SCHEDULED TRIGGER (History Retention / Compaction)
+# ================================================
+# Raw readings in /history/{deviceId} older than HISTORY_RETENTION_DAYS are
+# replaced by one summary node per HISTORY_BUCKET_MINUTES bucket. The summary
+# is keyed by the bucket start (ms) and keeps the mean under the original
+# field names, so the dashboard keeps reading it like a normal history entry.
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "30"))
+HISTORY_BUCKET_MINUTES = int(os.environ.get("HISTORY_BUCKET_MINUTES", "5"))
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "500"))
+HISTORY_MAX_PAGES_PER_RUN = int(os.environ.get("HISTORY_MAX_PAGES_PER_RUN", "200"))
+HISTORY_MAX_PATHS_PER_UPDATE = int(os.environ.get("HISTORY_MAX_PATHS_PER_UPDATE", "500"))
+HISTORY_RUN_BUDGET_SEC = int(os.environ.get("HISTORY_RUN_BUDGET_SEC", "480"))
+HISTORY_CHECKPOINT_PATH = "/maintenance/history_compaction"
+
+HISTORY_FEATURES = ['pH', 'TDS', 'water_level', 'DHT_temp', 'DHT_humidity']
+
+
+def history_cutoff_ms(now_ms, retention_days=None, bucket_minutes=None):
+    """
+    Cutoff (exclusive) for compaction, aligned down to a bucket boundary so a
+    bucket is never split between summarised and raw readings.
+    """
+    retention_days = HISTORY_RETENTION_DAYS if retention_days is None else retention_days
+    bucket_ms = (HISTORY_BUCKET_MINUTES if bucket_minutes is None else bucket_minutes) * 60 * 1000
+    cutoff = now_ms - retention_days * 24 * 60 * 60 * 1000
+    return (cutoff // bucket_ms) * bucket_ms
+
+
+def is_history_summary(value):
+    """True for nodes already written by the compaction job"""
+    return isinstance(value, dict) and value.get("downsampled") is True
+
+
+def summarize_bucket(bucket_start_ms, readings, bucket_minutes=None):
+    """
+    Downsample raw history readings that fall into one bucket.
+
+    Args:
+        bucket_start_ms: start of the bucket in epoch milliseconds
+        readings: list of raw history dicts (as written by predict_on_new_data)
+
+    Returns:
+        dict with mean (under the original key), _min and _max per feature,
+        plus the reading count and anomaly flags derived from `prediction`
+    """
+    bucket_minutes = HISTORY_BUCKET_MINUTES if bucket_minutes is None else bucket_minutes
+    summary = {}
+
+    for feat in HISTORY_FEATURES:
+        values = []
+        for reading in readings:
+            try:
+                values.append(float(reading[feat]))
+            except (KeyError, ValueError, TypeError):
+                continue
+        if values:
+            summary[feat] = sum(values) / len(values)
+            summary[f"{feat}_min"] = min(values)
+            summary[f"{feat}_max"] = max(values)
+
+    anomaly_count = sum(1 for reading in readings if reading.get("prediction") == 1)
+
+    summary.update({
+        # Worst case of the bucket, so alert history is not averaged away
+        "prediction": 1 if anomaly_count else 0,
+        "anomaly": anomaly_count > 0,
+        "anomaly_count": anomaly_count,
+        "count": len(readings),
+        "bucket_minutes": bucket_minutes,
+        "timestamp": datetime.utcfromtimestamp(bucket_start_ms / 1000).isoformat() + "Z",
+        "timestamp_ms": bucket_start_ms,
+        "downsampled": True
+    })
+    return summary
+
+
+def history_key_ms(key):
+    """History keys are epoch milliseconds; returns None for anything else"""
+    try:
+        return int(key)
+    except (ValueError, TypeError):
+        return None
+
+
+def group_history_page(page, bucket_minutes=None):
+    """
+    Split one page of history nodes into buckets of raw readings.
+
+    Returns:
+        (buckets, skipped) where buckets maps bucket_start_ms -> {key: reading}
+        in key order and skipped counts existing summaries / unparsable keys
+    """
+    bucket_ms = (HISTORY_BUCKET_MINUTES if bucket_minutes is None else bucket_minutes) * 60 * 1000
+    buckets = {}
+    skipped = 0
+
+    for key, value in page.items():
+        key_ms = history_key_ms(key)
+        if key_ms is None or is_history_summary(value) or not isinstance(value, dict):
+            skipped += 1
+            continue
+        bucket_start = (key_ms // bucket_ms) * bucket_ms
+        buckets.setdefault(bucket_start, {})[key] = value
+
+    return buckets, skipped
+
+
+def merge_summaries(existing, new):
+    """Merge two summaries of the same bucket, weighting means by reading count"""
+    merged = dict(new)
+    total = existing.get("count", 0) + new.get("count", 0)
+
+    for feat in HISTORY_FEATURES:
+        if feat not in existing:
+            continue
+        if feat not in new:
+            merged[feat] = existing[feat]
+            merged[f"{feat}_min"] = existing.get(f"{feat}_min", existing[feat])
+            merged[f"{feat}_max"] = existing.get(f"{feat}_max", existing[feat])
+            continue
+        merged[feat] = (
+            existing[feat] * existing.get("count", 0) + new[feat] * new.get("count", 0)
+        ) / total if total else new[feat]
+        # Hand-edited or older summaries may lack min/max; fall back to the mean
+        merged[f"{feat}_min"] = min(existing.get(f"{feat}_min", existing[feat]), new[f"{feat}_min"])
+        merged[f"{feat}_max"] = max(existing.get(f"{feat}_max", existing[feat]), new[f"{feat}_max"])
+
+    merged["anomaly_count"] = existing.get("anomaly_count", 0) + new.get("anomaly_count", 0)
+    merged["anomaly"] = merged["anomaly_count"] > 0
+    merged["prediction"] = 1 if merged["anomaly"] else 0
+    merged["count"] = total
+    return merged
+
+
+def build_compaction_batches(buckets, existing_summaries=None, max_paths=None):
+    """
+    Build multi-path updates replacing raw readings with bucket summaries.
+
+    Each bucket's summary and its deletions always land in the same update,
+    so a failed write never drops readings without their summary. Buckets
+    that already have a summary (from an earlier page or run) are merged
+    into it rather than overwriting it.
+    """
+    max_paths = HISTORY_MAX_PATHS_PER_UPDATE if max_paths is None else max_paths
+    existing_summaries = existing_summaries or {}
+    batches = []
+    current = {}
+
+    for bucket_start, readings in sorted(buckets.items()):
+        summary = summarize_bucket(bucket_start, list(readings.values()))
+        if bucket_start in existing_summaries:
+            summary = merge_summaries(existing_summaries[bucket_start], summary)
+
+        bucket_update = {key: None for key in readings}
+        # Overwrites the deletion if a raw reading sat exactly on the boundary
+        bucket_update[str(bucket_start)] = summary
+
+        if current and len(current) + len(bucket_update) > max_paths:
+            batches.append(current)
+            current = {}
+        current.update(bucket_update)
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def estimate_node_bytes(value):
+    """Approximate JSON size of a node, used for the dry-run report"""
+    return len(json.dumps(value, separators=(",", ":")))
+
+
+def compact_device_history(device_id, cutoff_ms, dry_run=False, deadline=None, max_pages=None):
+    """
+    Stream /history/{device_id} older than cutoff_ms in pages of
+    HISTORY_PAGE_SIZE and replace raw readings with bucket summaries.
+
+    Progress is checkpointed in /maintenance/history_compaction/{device_id}
+    after every page so an interrupted run resumes where it stopped. In
+    dry_run mode nothing is written; the returned report is the same one a
+    real run would produce. "summaries" counts buckets that gained a new
+    summary node, merges into an existing one only add to "summary_bytes".
+    """
+    max_pages = HISTORY_MAX_PAGES_PER_RUN if max_pages is None else max_pages
+    history_ref = db.reference(f"/history/{device_id}")
+    checkpoint_ref = db.reference(f"{HISTORY_CHECKPOINT_PATH}/{device_id}")
+
+    checkpoint = checkpoint_ref.get() or {}
+    cursor = checkpoint.get("cursor") if isinstance(checkpoint, dict) else None
+    if cursor and (
+        checkpoint.get("bucket_minutes") != HISTORY_BUCKET_MINUTES
+        or checkpoint.get("retention_days") != HISTORY_RETENTION_DAYS
+    ):
+        # The cursor was computed for another bucket layout / window; rescan
+        # from the start (existing summaries are skipped, so this is safe)
+        print(f"⚠️  {device_id}: compaction settings changed, resetting cursor")
+        cursor = None
+    end_key = str(cutoff_ms - 1)
+
+    report = {
+        "deviceId": device_id,
+        "cutoff_ms": cutoff_ms,
+        "pages": 0,
+        "raw_readings": 0,
+        "raw_bytes": 0,
+        "summaries": 0,
+        "summary_bytes": 0,
+        "skipped": 0,
+        "complete": False
+    }
+
+    # Keys this run has already accounted for. start_at() is inclusive and a
+    # dry run deletes nothing, so pages overlap on the cursor key.
+    processed_through = None
+    # Summaries built on the previous page, so a bucket continuing on this
+    # page merges into them (a dry run never writes them to the database)
+    carried = {}
+
+    while report["pages"] < max_pages:
+        if deadline is not None and time.time() >= deadline:
+            print(f"⏱️  Time budget reached for {device_id}, will resume next run")
+            break
+
+        query = history_ref.order_by_key()
+        if cursor:
+            query = query.start_at(cursor)
+        page = query.end_at(end_key).limit_to_first(HISTORY_PAGE_SIZE).get() or {}
+        if not page:
+            report["complete"] = True
+            break
+
+        report["pages"] += 1
+        keys = list(page.keys())
+        page_full = len(keys) >= HISTORY_PAGE_SIZE
+        next_cursor = keys[-1]
+
+        fresh = {
+            key: value for key, value in page.items()
+            if processed_through is None or key > processed_through
+        }
+        all_buckets, _ = group_history_page(fresh)
+        if page_full and len(all_buckets) > 1:
+            # The last bucket may continue on the next page; leave it raw and
+            # start the next page from its first reading.
+            next_cursor = min(all_buckets[max(all_buckets)])
+            fresh = {key: value for key, value in fresh.items() if key < next_cursor}
+        if fresh:
+            processed_through = max(fresh)
+
+        buckets, skipped = group_history_page(fresh)
+        report["skipped"] += skipped
+
+        existing_summaries = {
+            history_key_ms(key): value for key, value in fresh.items()
+            if is_history_summary(value) and history_key_ms(key) in buckets
+        }
+        # Only the first bucket can start before this page (it continues a
+        # bucket compacted on the previous page or run), so look its summary up.
+        if buckets:
+            first_bucket = min(buckets)
+            if first_bucket in carried:
+                existing_summaries[first_bucket] = carried[first_bucket]
+            elif first_bucket not in existing_summaries and str(first_bucket) not in fresh:
+                previous = history_ref.child(str(first_bucket)).get()
+                if is_history_summary(previous):
+                    existing_summaries[first_bucket] = previous
+
+        batches = build_compaction_batches(buckets, existing_summaries)
+        carried = {
+            int(key): value for batch in batches for key, value in batch.items()
+            if value is not None
+        }
+
+        for bucket_readings in buckets.values():
+            report["raw_readings"] += len(bucket_readings)
+            report["raw_bytes"] += sum(estimate_node_bytes(v) for v in bucket_readings.values())
+        for bucket_start, summary in carried.items():
+            if bucket_start in existing_summaries:
+                # Merged into a summary that already exists; only the growth counts
+                report["summary_bytes"] += (
+                    estimate_node_bytes(summary) - estimate_node_bytes(existing_summaries[bucket_start])
+                )
+            else:
+                report["summaries"] += 1
+                report["summary_bytes"] += estimate_node_bytes(summary)
+
+        if not dry_run:
+            for batch in batches:
+                history_ref.update(batch)
+            checkpoint_ref.set({
+                "cursor": next_cursor,
+                "bucket_minutes": HISTORY_BUCKET_MINUTES,
+                "retention_days": HISTORY_RETENTION_DAYS,
+                "updated_at": datetime.utcnow().isoformat() + "Z"
+            })
+            print(f"   ✓ {device_id}: page {report['pages']} compacted "
+                  f"{sum(len(b) for b in buckets.values())} readings into {len(buckets)} summaries")
+
+        if not page_full:
+            report["complete"] = True
+            break
+
+        if cursor is not None and next_cursor <= cursor:
+            # start_at() is inclusive, so with a page of one node only the
+            # cursor itself comes back; stop instead of re-reading it forever
+            print(f"⚠️  {device_id}: cursor stuck at {cursor}, stopping")
+            break
+        cursor = next_cursor
+
+    return report
+
+
+def run_history_compaction(dry_run=False, device_ids=None):
+    """
+    Compact every device under /history (or the given ones) and return
+    per-device reports. Runs are bounded by HISTORY_MAX_PAGES_PER_RUN and
+    HISTORY_RUN_BUDGET_SEC; a device with "complete": False resumes from its
+    checkpoint on the next run.
+    """
+    now_ms = int(datetime.utcnow().timestamp() * 1000)
+    cutoff_ms = history_cutoff_ms(now_ms)
+    deadline = time.time() + HISTORY_RUN_BUDGET_SEC
+
+    if device_ids is None:
+        # Shallow read: only the device keys, never the readings themselves
+        device_ids = list((db.reference("/history").get(shallow=True) or {}).keys())
+
+    print(f"🧹 History compaction (dry_run={dry_run}) for {len(device_ids)} devices, "
+          f"cutoff {datetime.utcfromtimestamp(cutoff_ms / 1000).isoformat()}Z")
+
+    reports = []
+    for device_id in device_ids:
+        if time.time() >= deadline:
+            print("⏱️  Time budget reached, remaining devices resume next run")
+            break
+        try:
+            reports.append(compact_device_history(device_id, cutoff_ms, dry_run=dry_run, deadline=deadline))
+        except Exception as e:
+            # One bad device must not stop compaction for the rest; its
+            # checkpoint still points at the last page that was written
+            print(f"❌ Error compacting history for {device_id}: {e}")
+            import traceback
+            traceback.print_exc()
+            reports.append({"deviceId": device_id, "error": str(e), "complete": False})
+
+    totals = {
+        "raw_readings": sum(r.get("raw_readings", 0) for r in reports),
+        "raw_bytes": sum(r.get("raw_bytes", 0) for r in reports),
+        "summaries": sum(r.get("summaries", 0) for r in reports),
+        "summary_bytes": sum(r.get("summary_bytes", 0) for r in reports),
+        "failed_devices": sum(1 for r in reports if "error" in r)
+    }
+    return {
+        "dry_run": dry_run,
+        "cutoff_ms": cutoff_ms,
+        "retention_days": HISTORY_RETENTION_DAYS,
+        "bucket_minutes": HISTORY_BUCKET_MINUTES,
+        "devices": reports,
+        "totals": totals
+    }
+
+
+@scheduler_fn.on_schedule(
+    schedule="every day 03:00",
+    region="europe-west1",
+    memory=512,
+    timeout_sec=540
+)
+def compact_history(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Nightly retention job: downsamples /history/{deviceId} readings older
+    than HISTORY_RETENTION_DAYS into HISTORY_BUCKET_MINUTES summaries.
+    """
+    try:
+        result = run_history_compaction(dry_run=False)
+        totals = result["totals"]
+        print(f"🎉 Compaction done: {totals['raw_readings']} readings → "
+              f"{totals['summaries']} summaries "
+              f"({totals['raw_bytes']} → {totals['summary_bytes']} bytes)")
+    except Exception as e:
+        print(f"❌ Error in history compaction: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+def verify_admin_request(req):
+    """
+    Check the Firebase ID token in the Authorization header.
+
+    Returns:
+        (status, error) - (None, None) when the caller is an admin
+    """
+    header = req.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return 401, "Missing bearer token"
+    try:
+        decoded = auth.verify_id_token(header[len("Bearer "):])
+    except Exception as e:
+        print(f"⚠️ Rejected ID token: {e}")
+        return 401, "Invalid token"
+    if decoded.get("admin") is not True:
+        return 403, "Admin access required"
+    return None, None
+
+
+@https_fn.on_request(region="europe-west1", memory=512, timeout_sec=540)
+def history_compaction_report(req: https_fn.Request) -> https_fn.Response:
+    """
+    Dry-run size report for the compaction job. Nothing is written.
+
+    Requires a Firebase ID token with the `admin` custom claim in the
+    Authorization header. Optional query parameter: ?deviceId=<id> to
+    report on a single device.
+    """
+    try:
+        status, error = verify_admin_request(req)
+        if error:
+            return https_fn.Response(
+                json.dumps({"error": error}),
+                status=status,
+                mimetype="application/json"
+            )
+
+        device_id = req.args.get("deviceId")
+        device_ids = None
+        if device_id:
+            # Only accept ids that already exist under /history; never build
+            # a database path from raw query input
+            known = db.reference("/history").get(shallow=True) or {}
+            if device_id not in known:
+                return https_fn.Response(
+                    json.dumps({"error": "Unknown deviceId"}),
+                    status=404,
+                    mimetype="application/json"
+                )
+            device_ids = [device_id]
+
+        result = run_history_compaction(dry_run=True, device_ids=device_ids)
+        return https_fn.Response(
+            json.dumps(result),
+            status=200,
+            mimetype="application/json"
+        )
+    except Exception as e:
+        print(f"❌ Error in history_compaction_report: {e}")
+        import traceback
+        traceback.print_exc()
+        return https_fn.Response(
+            json.dumps({"error": str(e)}),
+            status=500,
+            mimetype="application/json"
+        )
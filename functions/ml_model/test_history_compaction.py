@@ -0,0 +1,356 @@
+"""
+Behaviour tests for the /history compaction job, run against an in-memory
+stand-in for the Realtime Database
+"""
+import sys
+import os
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import firebase_admin
+from firebase_admin import credentials, storage
+
+# main.py initialises Firebase with a service account key at import time
+with mock.patch.object(credentials, "Certificate"), \
+        mock.patch.object(firebase_admin, "initialize_app"), \
+        mock.patch.object(storage, "bucket"):
+    import main
+
+
+BUCKET_MS = 5 * 60 * 1000
+T0 = 1_700_000_100_000 // BUCKET_MS * BUCKET_MS  # a bucket boundary
+
+
+class FakeQuery:
+    def __init__(self, ref):
+        self.ref = ref
+        self.start = None
+        self.end = None
+        self.limit = None
+
+    def start_at(self, value):
+        self.start = value
+        return self
+
+    def end_at(self, value):
+        self.end = value
+        return self
+
+    def limit_to_first(self, limit):
+        self.limit = limit
+        return self
+
+    def get(self):
+        node = self.ref.get() or {}
+        keys = sorted(
+            key for key in node
+            if (self.start is None or key >= self.start) and (self.end is None or key <= self.end)
+        )
+        return {key: node[key] for key in keys[:self.limit]}
+
+
+class FakeReference:
+    def __init__(self, store, path):
+        self.store = store
+        self.parts = [part for part in path.strip("/").split("/") if part]
+
+    def _node(self, create=False):
+        node = self.store
+        for part in self.parts:
+            if not isinstance(node, dict) or part not in node:
+                if not create:
+                    return None
+                node[part] = {}
+            node = node[part]
+        return node
+
+    def get(self, shallow=False):
+        node = self._node()
+        if shallow and isinstance(node, dict):
+            return {key: True for key in node}
+        return node
+
+    def set(self, value):
+        FakeReference(self.store, "/".join(self.parts[:-1]))._node(create=True)[self.parts[-1]] = value
+
+    def update(self, values):
+        node = self._node(create=True)
+        for key, value in values.items():
+            if value is None:
+                node.pop(key, None)
+            else:
+                node[key] = value
+
+    def child(self, path):
+        return FakeReference(self.store, "/".join(self.parts + [path]))
+
+    def order_by_key(self):
+        return FakeQuery(self)
+
+
+class FakeDb:
+    def __init__(self):
+        self.store = {}
+
+    def reference(self, path):
+        return FakeReference(self.store, path)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(main, "db", fake)
+    monkeypatch.setattr(main, "HISTORY_BUCKET_MINUTES", 5)
+    monkeypatch.setattr(main, "HISTORY_PAGE_SIZE", 500)
+    monkeypatch.setattr(main, "HISTORY_MAX_PAGES_PER_RUN", 200)
+    monkeypatch.setattr(main, "HISTORY_MAX_PATHS_PER_UPDATE", 500)
+    return fake
+
+
+def reading(pH=6.0, prediction=0):
+    return {"pH": pH, "TDS": 1000.0, "water_level": 1.0, "DHT_temp": 20.0,
+            "DHT_humidity": 60.0, "prediction": prediction}
+
+
+def seed_history(fake_db, timestamps, device_id="esp32-001"):
+    history = {str(ts): reading(pH=5.0 + (i % 20) / 10, prediction=int(i % 7 == 0))
+               for i, ts in enumerate(timestamps)}
+    fake_db.store.setdefault("history", {})[device_id] = history
+    return dict(history)
+
+
+def history_of(fake_db, device_id="esp32-001"):
+    return fake_db.store["history"][device_id]
+
+
+def summaries_of(fake_db, device_id="esp32-001"):
+    return {int(k): v for k, v in history_of(fake_db, device_id).items() if main.is_history_summary(v)}
+
+
+def assert_summaries_match(fake_db, original, cutoff_ms, device_id="esp32-001"):
+    """Every reading before the cutoff is in exactly one correct summary, the rest stay raw"""
+    old = {int(k): v for k, v in original.items() if int(k) < cutoff_ms}
+    expected = {}
+    for ts, value in old.items():
+        expected.setdefault(ts // BUCKET_MS * BUCKET_MS, []).append(value)
+
+    summaries = summaries_of(fake_db, device_id)
+    assert set(summaries) == set(expected)
+    for bucket_start, values in expected.items():
+        summary = summaries[bucket_start]
+        assert summary["count"] == len(values)
+        assert summary["pH"] == pytest.approx(sum(v["pH"] for v in values) / len(values))
+        assert summary["pH_min"] == min(v["pH"] for v in values)
+        assert summary["pH_max"] == max(v["pH"] for v in values)
+        assert summary["anomaly_count"] == sum(v["prediction"] for v in values)
+
+    raw = {k for k, v in history_of(fake_db, device_id).items() if not main.is_history_summary(v)}
+    assert raw == {k for k in original if int(k) >= cutoff_ms}
+
+
+# ----------------------------
+# Pure helpers
+# ----------------------------
+def test_history_cutoff_ms_aligns_down_to_bucket():
+    now_ms = T0 + 30 * 24 * 60 * 60 * 1000 + 123_456
+    assert main.history_cutoff_ms(now_ms, retention_days=30, bucket_minutes=5) == T0
+
+
+def test_summarize_bucket_keeps_mean_min_max_and_anomalies():
+    summary = main.summarize_bucket(T0, [reading(pH=5.0), reading(pH=7.0, prediction=1)], bucket_minutes=5)
+
+    assert summary["pH"] == 6.0
+    assert summary["pH_min"] == 5.0
+    assert summary["pH_max"] == 7.0
+    assert summary["count"] == 2
+    assert summary["anomaly_count"] == 1
+    assert summary["anomaly"] is True
+    assert summary["prediction"] == 1
+    assert summary["timestamp_ms"] == T0
+    assert summary["downsampled"] is True
+
+
+def test_group_history_page_skips_summaries_and_bad_keys():
+    page = {
+        str(T0): main.summarize_bucket(T0, [reading()]),
+        str(T0 + 1): reading(),
+        str(T0 + BUCKET_MS): reading(),
+        "not-a-timestamp": reading(),
+    }
+    buckets, skipped = main.group_history_page(page, bucket_minutes=5)
+
+    assert buckets == {T0: {str(T0 + 1): page[str(T0 + 1)]},
+                       T0 + BUCKET_MS: {str(T0 + BUCKET_MS): page[str(T0 + BUCKET_MS)]}}
+    assert skipped == 2
+
+
+def test_merge_summaries_weights_means_by_count():
+    first = main.summarize_bucket(T0, [reading(pH=5.0)] * 3)
+    second = main.summarize_bucket(T0, [reading(pH=7.0, prediction=1)])
+    merged = main.merge_summaries(first, second)
+
+    assert merged["pH"] == pytest.approx(5.5)
+    assert (merged["pH_min"], merged["pH_max"]) == (5.0, 7.0)
+    assert merged["count"] == 4
+    assert merged["anomaly_count"] == 1
+    assert merged["prediction"] == 1
+
+
+def test_merge_summaries_tolerates_missing_min_max():
+    existing = {"pH": 6.0, "count": 1, "downsampled": True}
+    merged = main.merge_summaries(existing, main.summarize_bucket(T0, [reading(pH=8.0)]))
+
+    assert merged["pH"] == pytest.approx(7.0)
+    assert (merged["pH_min"], merged["pH_max"]) == (6.0, 8.0)
+
+
+def test_build_compaction_batches_reading_on_bucket_boundary():
+    boundary = {str(T0): reading(pH=5.0), str(T0 + 1000): reading(pH=7.0)}
+    batches = main.build_compaction_batches({T0: boundary})
+
+    assert len(batches) == 1
+    # The boundary reading's key is overwritten by the summary, not deleted
+    assert batches[0][str(T0)]["count"] == 2
+    assert batches[0][str(T0 + 1000)] is None
+
+
+def test_build_compaction_batches_keeps_each_bucket_in_one_update():
+    buckets = {
+        T0 + i * BUCKET_MS: {str(T0 + i * BUCKET_MS + j): reading() for j in range(1, 4)}
+        for i in range(3)
+    }
+    batches = main.build_compaction_batches(buckets, max_paths=5)
+
+    assert len(batches) == 3
+    for batch in batches:
+        assert sum(1 for v in batch.values() if v is not None) == 1
+        assert sum(1 for v in batch.values() if v is None) == 3
+
+
+# ----------------------------
+# Paging and resume
+# ----------------------------
+def test_compacts_only_readings_before_cutoff(fake_db):
+    original = seed_history(fake_db, range(T0, T0 + 4 * BUCKET_MS, 20_000))
+    cutoff = T0 + 2 * BUCKET_MS
+
+    report = main.compact_device_history("esp32-001", cutoff)
+
+    assert report["complete"] is True
+    assert report["summaries"] == 2
+    assert report["raw_readings"] == 30
+    assert_summaries_match(fake_db, original, cutoff)
+
+
+def test_bucket_split_across_pages(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_PAGE_SIZE", 7)
+    original = seed_history(fake_db, range(T0 + 7_000, T0 + 6 * BUCKET_MS, 13_000))
+    cutoff = T0 + 6 * BUCKET_MS
+
+    report = main.compact_device_history("esp32-001", cutoff)
+
+    assert report["complete"] is True
+    assert report["summaries"] == 6
+    assert report["raw_readings"] == len(original)
+    assert_summaries_match(fake_db, original, cutoff)
+
+
+def test_page_full_of_one_bucket(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_PAGE_SIZE", 10)
+    # One reading every 0.5 s: 600 readings per bucket, many pages per bucket
+    original = seed_history(fake_db, range(T0, T0 + 2 * BUCKET_MS, 500))
+    cutoff = T0 + 2 * BUCKET_MS
+
+    report = main.compact_device_history("esp32-001", cutoff, max_pages=1000)
+
+    assert report["complete"] is True
+    assert report["summaries"] == 2
+    assert report["raw_readings"] == len(original)
+    assert_summaries_match(fake_db, original, cutoff)
+
+
+def test_reading_on_bucket_boundary_is_not_lost(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_PAGE_SIZE", 3)
+    timestamps = [T0, T0 + 60_000, T0 + BUCKET_MS, T0 + BUCKET_MS + 1, T0 + 2 * BUCKET_MS]
+    original = seed_history(fake_db, timestamps)
+    cutoff = T0 + 3 * BUCKET_MS
+
+    main.compact_device_history("esp32-001", cutoff)
+
+    assert_summaries_match(fake_db, original, cutoff)
+
+
+def test_bucket_split_across_runs_resumes_from_checkpoint(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_PAGE_SIZE", 25)
+    original = seed_history(fake_db, range(T0, T0 + 5 * BUCKET_MS, 3_000))
+    cutoff = T0 + 5 * BUCKET_MS
+
+    first = main.compact_device_history("esp32-001", cutoff, max_pages=3)
+    checkpoint = fake_db.store["maintenance"]["history_compaction"]["esp32-001"]
+    assert first["complete"] is False
+    assert checkpoint["cursor"] <= str(T0 + 75 * 3_000)
+
+    reports = [first]
+    while not reports[-1]["complete"]:
+        reports.append(main.compact_device_history("esp32-001", cutoff, max_pages=3))
+
+    assert sum(r["raw_readings"] for r in reports) == len(original)
+    assert sum(r["summaries"] for r in reports) == 5
+    assert_summaries_match(fake_db, original, cutoff)
+
+
+def test_checkpoint_reset_when_bucket_size_changes(fake_db, monkeypatch):
+    seed_history(fake_db, range(T0, T0 + BUCKET_MS, 30_000))
+    fake_db.store["maintenance"] = {"history_compaction": {"esp32-001": {
+        "cursor": str(T0 + BUCKET_MS), "bucket_minutes": 15,
+        "retention_days": main.HISTORY_RETENTION_DAYS,
+    }}}
+
+    report = main.compact_device_history("esp32-001", T0 + BUCKET_MS)
+
+    # The stale cursor would have skipped every reading
+    assert report["raw_readings"] == 10
+    assert fake_db.store["maintenance"]["history_compaction"]["esp32-001"]["bucket_minutes"] == 5
+
+
+def test_dry_run_counts_match_real_run(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_PAGE_SIZE", 50)
+    timestamps = list(range(T0, T0 + BUCKET_MS, 500)) + list(range(T0 + BUCKET_MS, T0 + 8 * BUCKET_MS, 17_000))
+    original = seed_history(fake_db, timestamps)
+    cutoff = T0 + 8 * BUCKET_MS
+
+    dry = main.compact_device_history("esp32-001", cutoff, dry_run=True, max_pages=1000)
+    assert history_of(fake_db) == original
+    assert "maintenance" not in fake_db.store
+
+    real = main.compact_device_history("esp32-001", cutoff, max_pages=1000)
+
+    for field in ("raw_readings", "raw_bytes", "summaries", "skipped", "complete"):
+        assert dry[field] == real[field], field
+    assert real["raw_readings"] == len(original)
+    assert real["summaries"] == len(summaries_of(fake_db)) == 8
+
+
+def test_run_history_compaction_isolates_device_errors(fake_db, monkeypatch):
+    seed_history(fake_db, [T0], device_id="broken")
+    seed_history(fake_db, [T0], device_id="healthy")
+    real_compact = main.compact_device_history
+
+    def compact(device_id, *args, **kwargs):
+        if device_id == "broken":
+            raise RuntimeError("write failed")
+        return real_compact(device_id, *args, **kwargs)
+
+    monkeypatch.setattr(main, "compact_device_history", compact)
+    monkeypatch.setattr(main, "history_cutoff_ms", lambda now_ms: T0 + BUCKET_MS)
+
+    result = main.run_history_compaction()
+    reports = {r["deviceId"]: r for r in result["devices"]}
+
+    assert reports["broken"]["error"] == "write failed"
+    assert reports["healthy"]["complete"] is True
+    assert result["totals"]["failed_devices"] == 1
+    assert summaries_of(fake_db, "healthy")